@@ -0,0 +1,105 @@
+from benchmark.checks import check_chunked_cross_entropy, check_train_mode_after_eval
+from benchmark.suite import CASES, run_suite, compare_backends, diff_results, load_results, save_results
+from config.config import get_config
+import argparse
+import tempfile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark Args')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the benchmark suite on tiny random models')
+    run_parser.add_argument("--output", type=str, required=True,
+                      help='path of the JSON results file')
+    run_parser.add_argument("--cases", choices=CASES, nargs='+', default=CASES,
+                      help='{dataset, train, memory, infer, metrics}')
+    run_parser.add_argument("--modeltypes", choices=['t5', 'bart'], nargs='+', default=['t5', 'bart'],
+                      help='{t5, bart}')
+    run_parser.add_argument("--device", type=str, default='cpu')
+    run_parser.add_argument("--workdir", type=str, default=None,
+                      help='where synthetic data and tiny models are written (default: temp dir)')
+    run_parser.add_argument("--quick", action='store_true',
+                      help='smaller data and fewer repeats, for smoke testing')
+
+    backends_parser = subparsers.add_parser('backends', help='compare torch and ONNX predict latency on the predict set of a config')
+    backends_parser.add_argument("--config-file", type=str, required=True)
+    backends_parser.add_argument("--predicttype", choices=['last', 'best'], default='best',
+                      help='{last, best}')
+    backends_parser.add_argument("--repeats", type=int, default=1)
+    backends_parser.add_argument("--output", type=str, default=None,
+                      help='path of the JSON results file')
+
+    subparsers.add_parser('check', help='check hand-written autograd functions against PyTorch references and that training steps run in train mode')
+
+    diff_parser = subparsers.add_parser('diff', help='compare two JSON results files')
+    diff_parser.add_argument("base", type=str)
+    diff_parser.add_argument("new", type=str)
+    diff_parser.add_argument("--threshold", type=float, default=0.1,
+                      help='relative change counted as a regression')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def check(args):
+    check_chunked_cross_entropy()
+    print("ChunkedCrossEntropy matches CrossEntropyLoss !")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        check_train_mode_after_eval(workdir)
+    print("Training steps run in train mode after evaluation !")
+
+
+def run(args):
+    check(args)
+
+    if args.workdir:
+        results = run_suite(args.workdir, args.cases, args.modeltypes, args.device, args.quick)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_suite(workdir, args.cases, args.modeltypes, args.device, args.quick)
+
+    save_results(results, args.output)
+
+    for case, metrics in results["results"].items():
+        print(f"{case}: {metrics}")
+    print(f"Saved {args.output} !")
+
+
+def backends(args):
+    results = compare_backends(get_config(args.config_file), args.predicttype, args.repeats)
+    if results is None:
+        return
+
+    for case, metrics in results["results"].items():
+        print(f"{case}: {metrics}")
+
+    if args.output:
+        save_results(results, args.output)
+        print(f"Saved {args.output} !")
+
+
+def diff(args):
+    rows, regressions = diff_results(load_results(args.base), load_results(args.new), args.threshold)
+
+    for case, metric, old, new, change, regressed in rows:
+        flag = "  <-- REGRESSION" if regressed else ""
+        print(f"{case:<40} {metric:<24} {old:>12.4f} -> {new:>12.4f} ({change:+.1%}){flag}")
+
+    print(f"\n{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'backends':
+        backends(args)
+    elif args.command == 'check':
+        check(args)
+    else:
+        exit(diff(args))
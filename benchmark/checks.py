@@ -0,0 +1,92 @@
+import os
+import torch
+from torch import nn
+
+from benchmark.suite import make_config
+from benchmark.synthetic import write_lexnorm_csv, build_tiny_model
+from core.executing import Executor
+from core.modeling import ChunkedCrossEntropy, chunked_cross_entropy
+
+
+def _loss_and_grads(loss_fn, hidden, lm_head):
+    hidden = hidden.detach().clone().requires_grad_(True)
+    lm_head.zero_grad()
+    loss = loss_fn(hidden)
+    loss.backward()
+    grads = [hidden.grad, lm_head.weight.grad] + ([lm_head.bias.grad] if lm_head.bias is not None else [])
+    return loss.detach(), [g.clone() for g in grads]
+
+
+def check_chunked_cross_entropy(pad_id = 0, vocab = 37, d_model = 8, chunk_size = 10, atol = 1e-8):
+    """Compares ``chunked_cross_entropy`` with ``CrossEntropyLoss(ignore_index=pad)`` in double precision.
+
+    Covers an lm_head with and without bias (vocab not a multiple of ``chunk_size``) and an
+    all-pad batch, where CrossEntropyLoss returns NaN and the chunked loss returns 0; the
+    gradients are zero for both. Raises AssertionError on mismatch.
+    """
+    generator = torch.Generator().manual_seed(0)
+    reference = nn.CrossEntropyLoss(ignore_index = pad_id)
+
+    for bias in [False, True]:
+        lm_head = nn.Linear(d_model, vocab, bias = bias).double()
+        hidden = torch.randn(3, 6, d_model, generator = generator, dtype = torch.double)
+
+        padded_targets = torch.randint(0, vocab, (3, 6), generator = generator)
+        padded_targets[:, -2:] = pad_id
+
+        for all_pad in [False, True]:
+            targets = torch.full((3, 6), pad_id) if all_pad else padded_targets
+
+            expected, expected_grads = _loss_and_grads(
+                lambda h: reference(lm_head(h).reshape(-1, vocab), targets.reshape(-1)), hidden, lm_head)
+            actual, actual_grads = _loss_and_grads(
+                lambda h: chunked_cross_entropy(h, lm_head, targets, pad_id, chunk_size), hidden, lm_head)
+
+            case = f"bias={bias}, all_pad={all_pad}"
+            if all_pad:
+                assert torch.isnan(expected) and actual == 0, f"{case}: loss {actual} vs {expected}"
+            else:
+                assert torch.allclose(actual, expected, atol = atol), f"{case}: loss {actual} vs {expected}"
+            for actual_grad, expected_grad in zip(actual_grads, expected_grads):
+                assert torch.allclose(actual_grad, expected_grad, atol = atol), f"{case}: gradients differ"
+
+        keep = padded_targets != pad_id
+        inputs = (hidden[keep].detach().clone().requires_grad_(True),
+                    lm_head.weight.detach().clone().requires_grad_(True),
+                    lm_head.bias.detach().clone().requires_grad_(True) if bias else None,
+                    padded_targets[keep], chunk_size)
+        assert torch.autograd.gradcheck(ChunkedCrossEntropy.apply, inputs), f"bias={bias}: gradcheck failed"
+
+    return True
+
+
+def check_train_mode_after_eval(workdir):
+    """Runs ``Executor._train_step`` on a tiny T5 with an evaluation after every step.
+
+    Checks that every training step still runs in train mode, which gradient checkpointing
+    and dropout depend on, although evaluation switches the model to eval mode. Raises
+    AssertionError otherwise.
+    """
+    write_lexnorm_csv(os.path.join(workdir, "train.csv"), size = 32, seed = 0)
+    write_lexnorm_csv(os.path.join(workdir, "dev.csv"), size = 8, seed = 1)
+    build_tiny_model("t5", os.path.join(workdir, "tiny_t5"))
+
+    exec = Executor(make_config(workdir, "t5", "cpu",
+                                GRADIENT_CHECKPOINTING = True,
+                                TRAIN_BATCH_SIZE = 8,
+                                NUM_TRAIN_STEP = 3,
+                                eval_after_steps = 1,
+                                max_eval_length = 16), "train")
+
+    modes = []
+    backward = exec._backward
+
+    def recording_backward(batch, chunks = 1):
+        modes.append(exec.model.training)
+        return backward(batch, chunks)
+
+    exec._backward = recording_backward
+    exec._train_step()
+
+    assert modes and all(modes), f"training steps ran in eval mode: {modes}"
+    return True
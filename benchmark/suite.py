@@ -0,0 +1,456 @@
+import os
+import gc
+import sys
+import json
+import random
+import platform
+import statistics
+import subprocess
+import tracemalloc
+from timeit import default_timer as timer
+
+import torch
+import transformers
+from torch.utils.data import DataLoader
+from yacs.config import CfgNode
+
+from core.augmentation import Augmenter
+from core.dataset import LexDataset, OnlineAugDataset, trim_collate
+from core.executing import Executor, _is_oom
+from core.export import OnnxLexModel
+from evaluation.err import compute_err_metrics
+
+from .synthetic import build_tiny_model, write_lexnorm_csv, make_sentence, make_noisy
+
+CASES = ["dataset", "train", "memory", "infer", "metrics"]
+
+TRAIN_VARIANTS = {
+    "train": {},
+    "train_fused_loss": {"FUSED_LOSS": True, "LOSS_VOCAB_CHUNK": 128},
+    "train_grad_ckpt": {"GRADIENT_CHECKPOINTING": True},
+    "train_adam_loop": {"OPTIMIZER_IMPL": "loop"},
+    "train_memory_saver": {"FUSED_LOSS": True, "LOSS_VOCAB_CHUNK": 128,
+                            "GRADIENT_CHECKPOINTING": True, "OPTIMIZER_IMPL": "loop"},
+}
+
+
+def make_config(workdir, modeltype, device, **overrides):
+    config = {
+        "DEVICE": device,
+        "SEED": 0,
+        "SAVE": False,
+        "SAVE_PATH": os.path.join(workdir, "models"),
+        "modeltype": modeltype,
+        "pretrained_name": os.path.join(workdir, f"tiny_{modeltype}"),
+        "DO_PRETRAINING": False,
+        "PRETRAIN_BATCH_SIZE": 16,
+        "TRAIN_BATCH_SIZE": 16,
+        "EVAL_BATCH_SIZE": 16,
+        "PREDICT_BATCH_SIZE": 16,
+        "LR": 0.0001,
+        "BETAS": [0.9, 0.98],
+        "warmup_step": 100,
+        "NUM_PRETRAIN_STEP": 1,
+        "show_loss_after_pretrain_steps": 1,
+        "save_after_pretrain_steps": 1,
+        "NUM_TRAIN_STEP": 1,
+        "show_loss_after_steps": 1,
+        "eval_after_steps": 1,
+        "max_eval_length": 64,
+        "pretrain_data_path": os.path.join(workdir, "train.csv"),
+        "train_path": os.path.join(workdir, "train.csv"),
+        "val_path": os.path.join(workdir, "dev.csv"),
+        "predict_path": os.path.join(workdir, "dev.csv"),
+        "src_max_token_len": 256,
+        "trg_max_token_len": 256,
+        "get_predict_score": True,
+        "max_predict_length": 64,
+    }
+    config.update(overrides)
+    return CfgNode(init_dict = config)
+
+
+def make_config_from(config, **overrides):
+    config = config.clone()
+    config.defrost()
+    for key, value in overrides.items():
+        config[key] = value
+    return config
+
+
+def _sync(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def _reset_peak(device):
+    if device.startswith("cuda"):
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+
+
+def _peak_mb(device):
+    if device.startswith("cuda"):
+        return torch.cuda.max_memory_allocated() / 2**20
+    return None
+
+
+def _release():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def bench_dataset(config, repeats):
+    tokenizer = transformers.AutoTokenizer.from_pretrained(config.pretrained_name)
+
+    def build():
+        return LexDataset(data_path = config.train_path,
+                            tokenizer = tokenizer,
+                            modeltype = config.modeltype,
+                            batch = 256,
+                            src_max_token_len = config.src_max_token_len,
+                            trg_max_token_len = config.trg_max_token_len)
+
+    times = []
+    for _ in range(repeats):
+        start = timer()
+        dataset = build()
+        times.append(timer() - start)
+
+    # tracemalloc slows the build down several times, so memory gets its own untimed run
+    tracemalloc.start()
+    build()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tensor_bytes = sum(t.element_size() * t.nelement()
+                        for item in dataset.data for t in item.values() if torch.is_tensor(t))
+
+    online = OnlineAugDataset(data_path = config.train_path,
+                                tokenizer = tokenizer,
+                                augmenter = Augmenter(),
+                                modeltype = config.modeltype,
+                                batch = 256,
+                                src_max_token_len = config.src_max_token_len,
+                                trg_max_token_len = config.trg_max_token_len)
+    start = timer()
+    for index in range(len(online)):
+        online[index]
+    online_time = timer() - start
+
+    return {"dataset": {
+        "samples": len(dataset),
+        "build_s": statistics.median(times),
+        "build_samples_per_s": len(dataset) / statistics.median(times),
+        "build_peak_python_mb": peak / 2**20,
+        "tensor_mb": tensor_bytes / 2**20,
+        "online_aug_samples_per_s": len(online) / online_time,
+    }}
+
+
+def saved_activation_mb(exec, batch):
+    """Non-parameter tensor bytes autograd keeps from one training forward pass for the backward pass.
+
+    Device independent, so it also reports the activation-memory effect of
+    GRADIENT_CHECKPOINTING / FUSED_LOSS on CPU. Grows linearly with the batch size.
+    """
+    param_storages = {p.untyped_storage().data_ptr() for p in exec.model.parameters()}
+    seen = set()
+    total = 0
+
+    def pack(tensor):
+        nonlocal total
+        ptr = tensor.untyped_storage().data_ptr()
+        if ptr not in param_storages and ptr not in seen:
+            seen.add(ptr)
+            total += tensor.untyped_storage().nbytes()
+        return tensor
+
+    exec.model.train()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = exec._compute_loss(batch)
+    del loss
+
+    return total / 2**20
+
+
+def bench_train(config, steps, warmup, variants = None):
+    results = {}
+
+    for name, overrides in (variants or {"train": {}}).items():
+        exec = Executor(make_config_from(config, **overrides), "train")
+        exec.model.train()
+
+        batches = []
+        while len(batches) < steps + warmup:
+            batches += list(exec.trainiter)
+        batches = batches[:steps + warmup]
+
+        for batch in batches[:warmup]:
+            exec._optimize(batch)
+
+        _reset_peak(config.DEVICE)
+        _sync(config.DEVICE)
+        samples = 0
+        tokens = 0
+        start = timer()
+        for batch in batches[warmup:]:
+            exec._optimize(batch)
+            samples += batch["input_ids"].shape[0]
+            tokens += int(batch["label_attention_mask"].sum())
+        _sync(config.DEVICE)
+        elapsed = timer() - start
+
+        results[name] = {
+            "steps": steps,
+            "step_ms": elapsed / steps * 1000,
+            "train_samples_per_s": samples / elapsed,
+            "train_tokens_per_s": tokens / elapsed,
+            "peak_cuda_mb": _peak_mb(config.DEVICE),
+            "saved_activation_mb": saved_activation_mb(exec, batches[-1]),
+        }
+        del exec
+        _release()
+
+    return results
+
+
+def bench_memory(config, variants, limit = 4096):
+    """Largest batch of worst-case (longest) samples each variant can train on, CUDA only."""
+    if not config.DEVICE.startswith("cuda"):
+        print("(!) memory case needs a CUDA device, skipped")
+        return {}
+
+    results = {}
+    for name, overrides in variants.items():
+        exec = Executor(make_config_from(config, **overrides), "train")
+        exec.model.train()
+        longest = max(range(len(exec.train_data)), key=lambda i: exec.train_data.lengths[i])
+
+        def fits(batch_size):
+            batch = trim_collate([exec.train_data[longest]] * batch_size)
+            ok = True
+            try:
+                exec.optim.zero_grad()
+                exec._backward(batch)
+                exec.optim.step()
+            except RuntimeError as e:
+                if not _is_oom(e):
+                    raise
+                ok = False
+            exec._free_memory()
+            return ok
+
+        batch_size = 1
+        while batch_size * 2 <= limit and fits(batch_size * 2):
+            batch_size *= 2
+
+        _reset_peak(config.DEVICE)
+        fits(batch_size)
+        results[f"{name}/memory"] = {
+            "max_batch_size": batch_size,
+            "max_batch_peak_cuda_mb": _peak_mb(config.DEVICE),
+        }
+        del exec
+        _release()
+
+    return results
+
+
+def bench_infer(config, workdir, batch_sizes, word_ranges, repeats):
+    exec = Executor(config, "predict")
+    results = {}
+
+    for min_words, max_words in word_ranges:
+        data_path = write_lexnorm_csv(os.path.join(workdir, f"infer_{min_words}_{max_words}.csv"),
+                                        size = max(batch_sizes) * 4,
+                                        min_words = min_words,
+                                        max_words = max_words,
+                                        seed = 1)
+        dataset = LexDataset(data_path = data_path,
+                                tokenizer = exec.tokenizer,
+                                modeltype = config.modeltype,
+                                batch = 256,
+                                src_max_token_len = config.src_max_token_len,
+                                trg_max_token_len = config.trg_max_token_len)
+
+        for batch_size in batch_sizes:
+            dataloader = DataLoader(dataset = dataset, batch_size = batch_size)
+            exec.infer(dataloader, config.max_predict_length)
+
+            times = []
+            for _ in range(repeats):
+                _sync(config.DEVICE)
+                start = timer()
+                exec.infer(dataloader, config.max_predict_length)
+                _sync(config.DEVICE)
+                times.append(timer() - start)
+
+            elapsed = statistics.median(times)
+            results[f"infer/words{min_words}-{max_words}/bs{batch_size}"] = {
+                "batch_ms": elapsed / len(dataloader) * 1000,
+                "infer_samples_per_s": len(dataset) / elapsed,
+            }
+
+    del exec
+    _release()
+    return results
+
+
+def compare_backends(config, predicttype = "best", repeats = 1):
+    """Times Executor.infer on the config's predict set with the torch model and its ONNX export."""
+    exec = Executor(make_config_from(config, PREDICT_BACKEND = "torch"), "predict", predicttype = predicttype)
+    if not exec._load_trained_checkpoint(predicttype):
+        return None
+
+    results = {}
+    predictions = {}
+    for backend in ["torch", "onnx"]:
+        if backend == "onnx":
+            exec.model = OnnxLexModel(exec._onnx_path(), num_threads = config.get("ONNX_THREADS", 0))
+
+        exec.infer(exec.predictiter, config.max_predict_length)
+        times = []
+        for _ in range(repeats):
+            _sync(config.DEVICE)
+            start = timer()
+            predictions[backend] = exec.infer(exec.predictiter, config.max_predict_length)
+            _sync(config.DEVICE)
+            times.append(timer() - start)
+
+        elapsed = statistics.median(times)
+        results[f"predict/{backend}"] = {
+            "batch_ms": elapsed / len(exec.predictiter) * 1000,
+            "infer_samples_per_s": len(exec.predict_data) / elapsed,
+        }
+
+    same = sum(t == o for t, o in zip(predictions["torch"], predictions["onnx"]))
+    results["predict/onnx"]["same_as_torch"] = same / len(predictions["torch"])
+
+    return {"meta": _meta(config.DEVICE), "results": results}
+
+
+def bench_metrics(size, repeats):
+    rng = random.Random(2)
+    trgs = [make_sentence(rng, 4, 24) for _ in range(size)]
+    srcs = [make_noisy(rng, s) for s in trgs]
+    preds = [make_noisy(rng, s, noise = 0.1) for s in trgs]
+
+    times = []
+    for _ in range(repeats):
+        start = timer()
+        compute_err_metrics(srcs, trgs, preds)
+        times.append(timer() - start)
+
+    return {"metrics": {
+        "sentences": size,
+        "err_s": statistics.median(times),
+        "err_sentences_per_s": size / statistics.median(times),
+    }}
+
+
+def _meta(device):
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                            stderr = subprocess.DEVNULL, text = True).strip()
+    except Exception:
+        commit = None
+
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "device": torch.cuda.get_device_name() if device.startswith("cuda") else platform.processor() or "cpu",
+        "threads": torch.get_num_threads(),
+        "commit": commit,
+    }
+
+
+def run_suite(workdir, cases = CASES, modeltypes = ("t5", "bart"), device = "cpu", quick = False):
+    """Runs the selected cases for every model type and returns a JSON-serializable dict."""
+    os.makedirs(workdir, exist_ok = True)
+
+    train_size = 256 if quick else 2048
+    repeats = 1 if quick else 3
+
+    write_lexnorm_csv(os.path.join(workdir, "train.csv"), size = train_size, seed = 0)
+    write_lexnorm_csv(os.path.join(workdir, "dev.csv"), size = 64, seed = 1)
+
+    results = {}
+    for modeltype in modeltypes:
+        torch.manual_seed(0)
+        build_tiny_model(modeltype, os.path.join(workdir, f"tiny_{modeltype}"))
+        config = make_config(workdir, modeltype, device)
+
+        if "dataset" in cases:
+            for name, res in bench_dataset(config, repeats).items():
+                results[f"{modeltype}/{name}"] = res
+
+        if "train" in cases:
+            for name, res in bench_train(config,
+                                            steps = 5 if quick else 30,
+                                            warmup = 1 if quick else 3,
+                                            variants = TRAIN_VARIANTS).items():
+                results[f"{modeltype}/{name}"] = res
+
+        if "memory" in cases:
+            for name, res in bench_memory(config, TRAIN_VARIANTS).items():
+                results[f"{modeltype}/{name}"] = res
+
+        if "infer" in cases:
+            for name, res in bench_infer(config, workdir,
+                                            batch_sizes = [1, 8] if quick else [1, 8, 32],
+                                            word_ranges = [(4, 8)] if quick else [(4, 8), (16, 32)],
+                                            repeats = repeats).items():
+                results[f"{modeltype}/{name}"] = res
+
+    if "metrics" in cases:
+        results.update(bench_metrics(size = 500 if quick else 5000, repeats = repeats))
+
+    return {"meta": _meta(device), "results": results}
+
+
+def _direction(metric):
+    if metric.endswith("_per_s") or metric == "max_batch_size":
+        return 1
+    if metric.endswith(("_s", "_ms", "_mb")):
+        return -1
+    return 0
+
+
+def diff_results(base, new, threshold = 0.1):
+    """Compares two result files; returns printable rows and the number of regressions."""
+    rows = []
+    regressions = 0
+
+    for case, metrics in new["results"].items():
+        base_metrics = base["results"].get(case)
+        if base_metrics is None:
+            continue
+
+        for metric, value in metrics.items():
+            old = base_metrics.get(metric)
+            direction = _direction(metric)
+            if direction == 0 or old is None or value is None or old == 0:
+                continue
+
+            change = (value - old) / old
+            regressed = change * direction < -threshold
+            regressions += regressed
+            rows.append((case, metric, old, value, change, regressed))
+
+    return rows, regressions
+
+
+def load_results(path):
+    with open(path, "r", encoding = "utf-8") as f:
+        return json.load(f)
+
+
+def save_results(results, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, "w", encoding = "utf-8") as f:
+        json.dump(results, f, ensure_ascii = False, indent = 4)
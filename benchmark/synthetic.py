@@ -0,0 +1,105 @@
+import os
+import random
+import unicodedata
+import pandas as pd
+
+from transformers import (ByT5Tokenizer,
+                            T5Config, T5ForConditionalGeneration,
+                            BartConfig, BartForConditionalGeneration)
+
+ONSETS = ["", "b", "c", "ch", "d", "đ", "g", "gi", "h", "k", "kh", "l", "m", "n",
+            "ng", "nh", "ph", "qu", "r", "s", "t", "th", "tr", "v", "x"]
+NUCLEI = ["a", "ă", "â", "e", "ê", "i", "o", "ô", "ơ", "u", "ư", "y",
+            "ai", "ao", "au", "ay", "oi", "ua", "ươ", "iê", "uô"]
+CODAS = ["", "", "", "c", "ch", "m", "n", "ng", "nh", "p", "t"]
+TONES = ["", "\u0301", "\u0300", "\u0309", "\u0303", "\u0323"]
+
+# the benchmark workload is frozen: keep this generator independent of core.augmentation,
+# otherwise results from different commits are measured on different data
+TEENCODE = {"không": "ko", "được": "dc", "gì": "j", "vậy": "z", "biết": "bít",
+            "rồi": "rùi", "người": "ng", "với": "vs", "quá": "wá", "thì": "thỳ"}
+
+
+def make_syllable(rng):
+    nucleus = rng.choice(NUCLEI)
+    nucleus = nucleus[:-1] + unicodedata.normalize("NFC", nucleus[-1] + rng.choice(TONES))
+    return rng.choice(ONSETS) + nucleus + rng.choice(CODAS)
+
+
+def make_sentence(rng, min_words, max_words):
+    words = []
+    for _ in range(rng.randint(min_words, max_words)):
+        if rng.random() < 0.15:
+            words.append(rng.choice(list(TEENCODE)))
+        else:
+            words.append(make_syllable(rng))
+    return " ".join(words)
+
+
+def strip_diacritics(word):
+    word = word.replace("đ", "d").replace("Đ", "D")
+    return "".join(c for c in unicodedata.normalize("NFD", word) if not unicodedata.combining(c))
+
+
+def make_noisy(rng, sentence, noise = 0.3):
+    words = []
+    for word in sentence.split():
+        if rng.random() < noise:
+            word = TEENCODE.get(word, strip_diacritics(word))
+        words.append(word)
+    return " ".join(words)
+
+
+def write_lexnorm_csv(path, size, min_words = 4, max_words = 24, seed = 0):
+    """Writes ``size`` synthetic (original, normalized) pairs in the layout LexDataset reads."""
+    rng = random.Random(seed)
+    normalized = [make_sentence(rng, min_words, max_words) for _ in range(size)]
+    original = [make_noisy(rng, s) for s in normalized]
+
+    pd.DataFrame({"original": original, "normalized": normalized}).to_csv(path, index=False)
+    return path
+
+
+def build_tiny_model(modeltype, out_dir):
+    """Saves a randomly initialized 2-layer seq2seq model and a ByT5 tokenizer to ``out_dir``.
+
+    The directory can be passed as ``pretrained_name`` so ``LexT5Model``/``LexBARTModel``
+    and ``AutoTokenizer`` load it without network access.
+    """
+    os.makedirs(out_dir, exist_ok = True)
+
+    tokenizer = ByT5Tokenizer()
+    tokenizer.save_pretrained(out_dir)
+
+    if modeltype == "t5":
+        config = T5Config(vocab_size = len(tokenizer),
+                            d_model = 64,
+                            d_kv = 16,
+                            d_ff = 128,
+                            num_layers = 2,
+                            num_decoder_layers = 2,
+                            num_heads = 4,
+                            pad_token_id = tokenizer.pad_token_id,
+                            eos_token_id = tokenizer.eos_token_id,
+                            decoder_start_token_id = tokenizer.pad_token_id)
+        model = T5ForConditionalGeneration(config)
+    else:
+        config = BartConfig(vocab_size = len(tokenizer),
+                            d_model = 64,
+                            encoder_layers = 2,
+                            decoder_layers = 2,
+                            encoder_attention_heads = 4,
+                            decoder_attention_heads = 4,
+                            encoder_ffn_dim = 128,
+                            decoder_ffn_dim = 128,
+                            max_position_embeddings = 1024,
+                            pad_token_id = tokenizer.pad_token_id,
+                            bos_token_id = tokenizer.eos_token_id,
+                            eos_token_id = tokenizer.eos_token_id,
+                            decoder_start_token_id = tokenizer.eos_token_id,
+                            forced_bos_token_id = None,
+                            forced_eos_token_id = None)
+        model = BartForConditionalGeneration(config)
+
+    model.save_pretrained(out_dir)
+    return out_dir
@@ -0,0 +1,81 @@
+import unicodedata
+
+# common Vietnamese social-media abbreviations, normalized word -> noisy spellings
+TEENCODE = {
+    "không": ["ko", "k", "hk", "hông", "kh"],
+    "được": ["dc", "đc", "dk", "đk"],
+    "gì": ["j", "gi"],
+    "vậy": ["z", "v", "zậy", "vậi"],
+    "biết": ["bít", "bik", "bit"],
+    "rồi": ["rùi", "r", "ròi"],
+    "người": ["ng", "ngừi"],
+    "với": ["vs", "zới", "vớii"],
+    "quá": ["wá", "qá", "qua"],
+    "thì": ["thỳ", "th"],
+    "anh": ["a"],
+    "em": ["e"],
+    "yêu": ["iu", "yeu"],
+    "bạn": ["bn", "b"],
+    "mình": ["mk", "mik", "m"],
+    "chồng": ["ck"],
+    "vợ": ["vk"],
+    "đi": ["dj", "đj"],
+    "cũng": ["cg", "cũg"],
+    "nhưng": ["nhg", "nhưg"],
+    "trước": ["trc"],
+    "chưa": ["chx", "chua"],
+    "nhiều": ["nhìu", "nhiu"],
+    "luôn": ["lun"],
+    "ừ": ["uk", "uh"],
+    "vui": ["zui"],
+    "thôi": ["thui"],
+    "nha": ["nhaa", "nhé"],
+}
+
+# spelling substitutions applied inside a word
+CHAR_RULES = [("ph", "f"), ("qu", "w"), ("gi", "j"), ("d", "z"), ("ng", "g"), ("c", "k")]
+
+
+def strip_diacritics(word):
+    word = word.replace("đ", "d").replace("Đ", "D")
+    return "".join(c for c in unicodedata.normalize("NFD", word) if not unicodedata.combining(c))
+
+
+class Augmenter():
+    """Turns clean (normalized) text into a noisy source sentence, one word at a time.
+
+    Every random draw comes from the ``rng`` passed to ``__call__`` (a ``random.Random``),
+    so the output is reproducible for a given seed.
+    """
+    def __init__(self,
+                teencode_prob = 0.3,
+                char_rule_prob = 0.05,
+                diacritic_prob = 0.15,
+                repeat_prob = 0.03,
+                max_repeat = 3):
+        self.teencode_prob = teencode_prob
+        self.char_rule_prob = char_rule_prob
+        self.diacritic_prob = diacritic_prob
+        self.repeat_prob = repeat_prob
+        self.max_repeat = max_repeat
+
+    def noise_word(self, word, rng):
+        lowered = word.lower()
+        if lowered in TEENCODE and rng.random() < self.teencode_prob:
+            return rng.choice(TEENCODE[lowered])
+
+        if rng.random() < self.char_rule_prob:
+            src, trg = rng.choice(CHAR_RULES)
+            if src in lowered:
+                word = lowered.replace(src, trg, 1)
+
+        if rng.random() < self.diacritic_prob:
+            word = strip_diacritics(word)
+
+        if word and rng.random() < self.repeat_prob:
+            word = word + word[-1] * rng.randint(1, self.max_repeat)
+
+        return word
+
+    def __call__(self, text, rng):
+        return " ".join(self.noise_word(word, rng) for word in text.split())
@@ -1,8 +1,10 @@
+import math
 import torch
+import random
 import numpy as np
 from tqdm import tqdm
 import pandas as pd
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler, default_collate
 
 class LexDataset(Dataset):
     def __init__(   self,
@@ -20,6 +22,7 @@ class LexDataset(Dataset):
         self.trg_max_token_len = trg_max_token_len
 
         self.data = list()
+        self.lengths = list()
 
         dataframe = pd.read_csv(data_path)
 
@@ -50,7 +53,9 @@ class LexDataset(Dataset):
 
 
                 self.data.append({'input_ids': src_id.flatten(), 'labels': trg_id.flatten(),
-                                "src_attention_mask":src_attention_mask.flatten(), "label_attention_mask": label_attention_mask.flatten(), })
+                                "src_attention_mask":src_attention_mask.flatten(), "label_attention_mask": label_attention_mask.flatten(),
+                                "index": index})
+                self.lengths.append(max(sum(src_masks[index]), sum(trg_masks[index])))
                 
                 pbar.update()
 
@@ -92,3 +97,180 @@ class LexDataset(Dataset):
 
     def __getitem__(self, index: int):
         return self.data[index]
+
+
+class OnlineAugDataset(LexDataset):
+    """LexDataset whose sources are synthesized from the clean ``normalized`` text on every access.
+
+    The noise for sample ``index`` is drawn from ``random.Random(f"{seed}:{epoch}:{index}")``,
+    so it changes with ``set_epoch`` but does not depend on DataLoader workers or batching.
+    When the CSV also has real sources (``original``/``ceg``), they are kept with
+    probability ``real_prob``.
+
+    With ``cap_lengths`` (for token-budget batching), ``lengths`` include headroom for the
+    noise, measured as a high quantile of the relative source growth over sample draws, and
+    a source longer than ``lengths[index]`` is redrawn up to ``max_attempts`` times before
+    falling back to the clean text.
+    """
+    def __init__(   self,
+                    data_path,
+                    tokenizer,
+                    augmenter,
+                    modeltype = "t5",
+                    batch = 256,
+                    src_max_token_len = 256,
+                    trg_max_token_len = 256,
+                    seed = 0,
+                    real_prob = 0.0,
+                    cap_lengths = False,
+                    max_attempts = 3):
+        Dataset.__init__(self)
+
+        self.tokenizer = tokenizer
+        self.augmenter = augmenter
+        self.modeltype = modeltype
+        self.src_max_token_len = src_max_token_len
+        self.trg_max_token_len = trg_max_token_len
+        self.seed = seed
+        self.real_prob = real_prob
+        self.cap_lengths = cap_lengths
+        self.max_attempts = max_attempts
+        self.epoch = 0
+
+        self.data = list()
+        self.lengths = list()
+
+        dataframe = pd.read_csv(data_path)
+
+        trg_column = "normalized" if "normalized" in dataframe else "norm"
+        src_column = next((c for c in ["original", "ceg"] if c in dataframe), trg_column)
+        self.has_real = src_column != trg_column
+
+        dataframe = pd.DataFrame({"src": dataframe[src_column], "trg": dataframe[trg_column]})
+
+        self.prepare_io(dataframe, batch)
+
+        if cap_lengths:
+            # augmented sources are built from the clean text and usually tokenize longer
+            # (repeated characters, and stripped diacritics or spelling rules for subword
+            # tokenizers), so the batch sampler plans with that growth
+            growth = self._measure_growth()
+            print(f"\t- Noisy sources are up to {growth:.1%} longer (99th percentile)")
+            for index in range(len(self.trg)):
+                clean_len = int(self.data[index]['label_attention_mask'].sum())
+                self.lengths[index] = max(self.lengths[index], min(math.ceil(clean_len * (1 + growth)), self.src_max_token_len))
+
+    def _measure_growth(self, samples = 1000, draws = 4, quantile = 0.99):
+        rng = random.Random(f"{self.seed}:lengths")
+        texts = [self.trg[i].strip() for i in rng.sample(range(len(self.trg)), min(samples, len(self.trg)))]
+        clean = [len(ids) for ids in self.tokenizer(texts)["input_ids"]]
+
+        growth = []
+        for _ in range(draws):
+            noisy = self.tokenizer([self.augmenter(text, rng) for text in texts])["input_ids"]
+            growth += [(len(ids) - n) / n for ids, n in zip(noisy, clean)]
+        growth.sort()
+
+        return max(0.0, growth[int(quantile * (len(growth) - 1))]) if growth else 0.0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __getitem__(self, index: int):
+        item = self.data[index]
+        rng = random.Random(f"{self.seed}:{self.epoch}:{index}")
+
+        if self.has_real and rng.random() < self.real_prob:
+            return item
+
+        # with cap_lengths, noise that outgrows the planned length is redrawn, the clean text
+        # being the last resort, so a token-budget batch never exceeds its budget
+        text = self.trg[index].strip()
+        attempts = self.max_attempts if self.cap_lengths else 1
+        for attempt in range(attempts + 1):
+            src = self.augmenter(text, rng) if attempt < attempts else text
+            src_encoding = self.tokenizer(src,
+                                            padding='max_length',
+                                            max_length = self.src_max_token_len,
+                                            truncation = True)
+            if not self.cap_lengths or sum(src_encoding["attention_mask"]) <= self.lengths[index]:
+                break
+
+        return {**item,
+                'input_ids': torch.tensor(src_encoding["input_ids"], dtype=torch.int32),
+                'src_attention_mask': torch.tensor(src_encoding["attention_mask"], dtype=torch.int32)}
+
+
+def trim_collate(items):
+    """Stacks a batch and cuts the max_length padding down to the longest sequence in it."""
+    batch = default_collate(items)
+
+    src_len = int(batch['src_attention_mask'].sum(dim=1).max())
+    trg_len = int(batch['label_attention_mask'].sum(dim=1).max())
+
+    batch['input_ids'] = batch['input_ids'][:, :src_len]
+    batch['src_attention_mask'] = batch['src_attention_mask'][:, :src_len]
+    batch['labels'] = batch['labels'][:, :trg_len]
+    batch['label_attention_mask'] = batch['label_attention_mask'][:, :trg_len]
+
+    return batch
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Groups samples of similar length so that ``batch size * longest length <= max_tokens``.
+
+    With ``shuffle`` the samples are bucketed inside random pools of ``pool_size`` batches'
+    worth of data and the batch order is shuffled, reseeded from ``seed`` on every epoch.
+    Without it the whole dataset is sorted by length; use the ``index`` field of the batch
+    to restore the original order.
+    """
+    def __init__(self,
+                lengths,
+                max_tokens,
+                shuffle = False,
+                seed = 0,
+                pool_size = 100):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.pool_size = pool_size
+        self.epoch = 0
+
+    def _batches(self, epoch):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + epoch)
+            order = torch.randperm(len(self.lengths), generator=generator).tolist()
+            pool = max(1, self.pool_size * self.max_tokens // max(self.lengths))
+        else:
+            order = list(range(len(self.lengths)))
+            pool = len(order)
+
+        batches = []
+        for i in range(0, len(order), pool):
+            batch = []
+            longest = 0
+            for index in sorted(order[i:i+pool], key=lambda idx: self.lengths[idx]):
+                length = self.lengths[index]
+                if batch and (len(batch) + 1) * max(longest, length) > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                    longest = 0
+                batch.append(index)
+                longest = max(longest, length)
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        return batches
+
+    def __iter__(self):
+        batches = self._batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._batches(self.epoch))
@@ -5,8 +5,10 @@ from torch.utils.data import DataLoader
 
 from logger.logger import Logger
 
-from .dataset import LexDataset
+from .dataset import LexDataset, OnlineAugDataset, TokenBudgetBatchSampler, trim_collate
+from .augmentation import Augmenter
 from .modeling import LexBARTModel, LexT5Model
+from .export import export_onnx, OnnxLexModel
 
 from timeit import default_timer as timer
 from tqdm import tqdm
@@ -19,6 +21,12 @@ from transformers import set_seed
 import random
 
 
+def _is_oom(error):
+    if hasattr(torch.cuda, "OutOfMemoryError") and isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    return "out of memory" in str(error)
+
+
 class Executor():
     def __init__(self, config, mode = 'train', evaltype='last', predicttype='best'):
         print("---Initializing Executor---")
@@ -33,6 +41,9 @@ class Executor():
         self.predicttype = predicttype
 
         self.best_score = 0
+        self.resumed = False
+        self.log = None
+        self.checkpoint = None
 
         if self.mode == "train":
             self._create_data_utils()       
@@ -42,15 +53,26 @@ class Executor():
             else:
                 self.model = LexBARTModel(self.config.pretrained_name)
 
+            if self.config.get("GRADIENT_CHECKPOINTING", False):
+                self.model.enable_gradient_checkpointing()
+
             self.model = self.model.to(self.config.DEVICE)
 
-            self.optim = torch.optim.Adam(self.model.parameters(), lr=config.LR, betas=config.BETAS, eps=1e-9)
+            self.optim = self._create_optimizer()
 
             self.loss_fn = torch.nn.CrossEntropyLoss(ignore_index=self.tokenizer.pad_token_id)
             
             self.scheduler = torch.optim.lr_scheduler.LinearLR(optimizer = self.optim, total_iters = config.warmup_step)
 
             self.SAVE = config.SAVE
+
+            self.max_tokens = self.config.get("MAX_TOKENS_PER_BATCH", None)
+            # chunk count of the last out-of-memory split, kept across steps
+            self.chunks = 1
+            self.chunked_steps = 0
+            if self.config.get("PROBE_MAX_TOKENS", False):
+                self.max_tokens = self._probe_max_tokens()
+
             self._create_dataloader()
 
             if os.path.isfile(os.path.join(self.config.SAVE_PATH, "last_ckp.pth")):
@@ -64,59 +86,75 @@ class Executor():
                 self.optim.load_state_dict(ckp['optimizer'])
                 self.scheduler.load_state_dict(ckp['scheduler'])
                 self.best_score = ckp['best_score']
+                self.resumed = True
             
-        if self.mode in ["eval", "predict"]:
+        if self.mode in ["eval", "predict", "export"]:
             self.init_eval_predict_mode()
 
-           
-            if self.config.modeltype == "t5":
-                self.model = LexT5Model(self.config.pretrained_name)
+            if self.mode == "predict" and self.config.get("PREDICT_BACKEND", "torch") == "onnx":
+                print(f"###Load ONNX export from {self._onnx_path()} ...")
+                self.model = OnnxLexModel(self._onnx_path(), num_threads = self.config.get("ONNX_THREADS", 0))
             else:
-                self.model = LexBARTModel(self.config.pretrained_name)
+                if self.config.modeltype == "t5":
+                    self.model = LexT5Model(self.config.pretrained_name)
+                else:
+                    self.model = LexBARTModel(self.config.pretrained_name)
 
-            self.model = self.model.to(self.config.DEVICE)
+                self.model = self.model.to(self.config.DEVICE)
     
     def run(self):
-        log = Logger("./terminal.txt")
-        log.start()
-
-        if self.mode =='train':
-            if self.config.DO_PRETRAINING:
-                self._pretrain_step()
-            self._train_step()
-        elif self.mode == 'eval':
-            self.evaluate()
-        elif self.mode == 'predict':
-            self.predict()
-        else:
-            exit(-1)
-
-        log.stop()
+        self.log = Logger("./terminal.txt",
+                            metrics_filename = "./metrics.jsonl",
+                            resume = self.resumed or self.mode != "train",
+                            max_bytes = self.config.get("LOG_MAX_BYTES", 10 * 1024 * 1024),
+                            backup_count = self.config.get("LOG_BACKUP_COUNT", 5),
+                            progress_interval = self.config.get("LOG_PROGRESS_INTERVAL", 5.0))
+        self.log.start()
+
+        try:
+            if self.mode =='train':
+                if self.config.DO_PRETRAINING:
+                    self._pretrain_step()
+                self._train_step()
+            elif self.mode == 'eval':
+                self.evaluate()
+            elif self.mode == 'predict':
+                self.predict()
+            elif self.mode == 'export':
+                self.export()
+            else:
+                exit(-1)
+        except (Exception, KeyboardInterrupt):
+            self.log.log_exception()
+            raise
+        finally:
+            self.log.stop()
+
+    def _create_optimizer(self):
+        impl = self.config.get("OPTIMIZER_IMPL", "default")
+        kwargs = {}
+
+        if impl == "fused":
+            kwargs["fused"] = True
+        elif impl == "foreach":
+            kwargs["foreach"] = True
+        elif impl == "loop":
+            # per-parameter updates, no multi-tensor temporaries: lowest peak memory
+            kwargs["foreach"] = False
+        elif impl != "default":
+            raise ValueError(f"Unknown OPTIMIZER_IMPL: {impl}")
+
+        return torch.optim.Adam(self.model.parameters(), lr=self.config.LR, betas=self.config.BETAS, eps=1e-9, **kwargs)
+
+    def _log_metrics(self, **record):
+        if self.log is not None:
+            self.log.log_metrics(mode = self.mode, **record)
 
 
     def evaluate(self):
         print("###Evaluate Mode###")
 
-        if os.path.isfile(os.path.join(self.config.SAVE_PATH, f"{self.evaltype}_ckp.pth")):
-            print("###Load trained checkpoint ...")
-            ckp = torch.load(os.path.join(self.config.SAVE_PATH, f"{self.evaltype}_ckp.pth"))
-            try:
-                print(f"\t- Using {self.evaltype} train epoch: {ckp['epoch']}")
-            except:
-                print(f"\t- Using {self.evaltype} train step: {ckp['step']}")
-            self.model.load_state_dict(ckp['state_dict'])
-
-        elif os.path.isfile(os.path.join('./models', f"{self.evaltype}_ckp.pth")):
-            print("###Load trained checkpoint ...")
-            ckp = torch.load(os.path.join('./models', f"{self.evaltype}_ckp.pth"))
-            try:
-                print(f"\t- Using {self.evaltype} train epoch: {ckp['epoch']}")
-            except:
-                print(f"\t- Using {self.evaltype} train step: {ckp['step']}")
-            self.model.load_state_dict(ckp['state_dict'])
-        
-        else:
-            print(f"(!) {self.evaltype}_ckp.pth is required (!)")
+        if not self._load_trained_checkpoint(self.evaltype):
             return 
         
         with torch.no_grad():
@@ -124,40 +162,30 @@ class Executor():
 
             res = self._evaluate_metrics()
             print(res)
+            self._log_metrics(phase = "eval", **res)
     
     def predict(self): 
         print("###Predict Mode###")
-        if os.path.isfile(os.path.join(self.config.SAVE_PATH, f"{self.predicttype}_ckp.pth")):
-            print("###Load trained checkpoint ...")
-            ckp = torch.load(os.path.join(self.config.SAVE_PATH, f"{self.predicttype}_ckp.pth"))
-            try:
-                print(f"\t- Using {self.predicttype} train epoch: {ckp['epoch']}")
-            except:
-                print(f"\t- Using {self.predicttype} train step: {ckp['step']}")
-            self.model.load_state_dict(ckp['state_dict'])
-
-        elif os.path.isfile(os.path.join('./models', f"{self.predicttype}_ckp.pth")):
-            print("###Load trained checkpoint ...")
-            ckp = torch.load(os.path.join('./models', f"{self.predicttype}_ckp.pth"))
-            try:
-                print(f"\t- Using {self.predicttype} train epoch: {ckp['epoch']}")
-            except:
-                print(f"\t- Using {self.predicttype} train step: {ckp['step']}")
-            self.model.load_state_dict(ckp['state_dict'])
-        else:
-            print(f"(!) {self.predicttype}_ckp.pth is required  (!)")
+        if isinstance(self.model, OnnxLexModel):
+            checkpoint = self.model.meta.get("checkpoint") or {}
+            print(f"\t- Using ONNX backend, exported from {checkpoint.get('type', 'an unknown')}_ckp.pth"
+                    + (f" (step {checkpoint['step']})" if "step" in checkpoint else ""))
+        elif not self._load_trained_checkpoint(self.predicttype):
             return
 
         print("## START PREDICTING ... ")
+        s_predict_time = timer()
 
         if self.config.get_predict_score:
             results, scores = self._evaluate_metrics()
             print(f'\t#PREDICTION:\n')
             print(f'\t{scores}')
+            self._log_metrics(phase = "predict", **scores)
         else:
             preds = self.infer(self.predictiter, self.config.max_predict_length)
             results = [{"pred": p} for p in preds]
 
+        print(f"#----------- PREDICTING END-Time: {timer() - s_predict_time} -----------------#")
 
         if self.config.SAVE_PATH:
             with open(os.path.join(self.config.SAVE_PATH, "results.json"), 'w', encoding='utf-8') as f:
@@ -167,6 +195,49 @@ class Executor():
             with open(os.path.join(".","results.csv"), 'w', encoding='utf-8') as f:
                 json.dump(results, f, ensure_ascii=False, indent=4)
             print("Saved Results !")
+
+    def export(self):
+        print("###Export Mode###")
+        if not self._load_trained_checkpoint(self.predicttype):
+            return
+
+        folder = self._onnx_path()
+        export_onnx(self.model, self.tokenizer, folder, self.config.modeltype,
+                    opset = self.config.get("ONNX_OPSET", 14),
+                    checkpoint = self.checkpoint)
+        print(f"Saved ONNX graphs to {folder} !")
+
+        try:
+            onnx_model = OnnxLexModel(folder)
+        except ImportError:
+            print("(!) onnxruntime is not installed, skip checking the exported graphs")
+            return
+
+        self.model.eval()
+        input_ids = torch.tensor(self.tokenizer(["ko bít lm j lun", "hum nay trời đẹp wá"], padding=True)["input_ids"])
+        with torch.no_grad():
+            expected = self.model.generate(input_ids = input_ids.to(self.config.DEVICE), max_length = 32).cpu()
+        same = torch.equal(expected, onnx_model.generate(input_ids = input_ids, max_length = 32))
+        print(f"\t- ONNX greedy outputs match torch generate: {same}")
+
+    def _onnx_path(self):
+        return self.config.get("ONNX_PATH", None) or os.path.join(self.config.SAVE_PATH or './models', "onnx")
+
+    def _load_trained_checkpoint(self, ckptype):
+        for folder in [self.config.SAVE_PATH, './models']:
+            if folder and os.path.isfile(os.path.join(folder, f"{ckptype}_ckp.pth")):
+                print("###Load trained checkpoint ...")
+                ckp = torch.load(os.path.join(folder, f"{ckptype}_ckp.pth"))
+                try:
+                    print(f"\t- Using {ckptype} train epoch: {ckp['epoch']}")
+                except:
+                    print(f"\t- Using {ckptype} train step: {ckp['step']}")
+                self.model.load_state_dict(ckp['state_dict'])
+                self.checkpoint = {"type": ckptype, **{k: ckp[k] for k in ["epoch", "step"] if k in ckp}}
+                return True
+
+        print(f"(!) {ckptype}_ckp.pth is required (!)")
+        return False
             
     def _create_data_utils(self):
         
@@ -183,7 +254,25 @@ class Executor():
                                             src_max_token_len = self.config.src_max_token_len,
                                             trg_max_token_len = self.config.trg_max_token_len)
         
-        self.train_data = LexDataset(data_path = self.config.train_path,
+        if self.config.get("ONLINE_AUG", False):
+            augmenter = Augmenter(teencode_prob = self.config.get("AUG_TEENCODE_PROB", 0.3),
+                                    char_rule_prob = self.config.get("AUG_CHAR_RULE_PROB", 0.05),
+                                    diacritic_prob = self.config.get("AUG_DIACRITIC_PROB", 0.15),
+                                    repeat_prob = self.config.get("AUG_REPEAT_PROB", 0.03),
+                                    max_repeat = self.config.get("AUG_MAX_REPEAT", 3))
+            self.train_data = OnlineAugDataset(data_path = self.config.train_path,
+                                            tokenizer = self.tokenizer,
+                                            augmenter = augmenter,
+                                            modeltype = self.config.modeltype,
+                                            batch = 256,
+                                            src_max_token_len = self.config.src_max_token_len,
+                                            trg_max_token_len = self.config.trg_max_token_len,
+                                            seed = self.config.SEED,
+                                            real_prob = self.config.get("AUG_REAL_PROB", 0.0),
+                                            cap_lengths = bool(self.config.get("MAX_TOKENS_PER_BATCH", None)
+                                                                or self.config.get("PROBE_MAX_TOKENS", False)))
+        else:
+            self.train_data = LexDataset(data_path = self.config.train_path,
                                             tokenizer = self.tokenizer,
                                             modeltype = self.config.modeltype,
                                             batch = 256,
@@ -201,15 +290,36 @@ class Executor():
         print("# Creating DataLoaders")
 
         if self.config.DO_PRETRAINING:
-            self.pretrainiter = DataLoader(dataset = self.pretrain_data, 
-                                    batch_size=self.config.PRETRAIN_BATCH_SIZE, 
+            self.pretrainiter = self._make_dataloader(self.pretrain_data,
+                                    batch_size=self.config.PRETRAIN_BATCH_SIZE,
+                                    max_tokens=self.max_tokens,
                                     shuffle=True)
        
-        self.trainiter = DataLoader(dataset = self.train_data, 
-                                    batch_size=self.config.TRAIN_BATCH_SIZE, 
+        self.trainiter = self._make_dataloader(self.train_data,
+                                    batch_size=self.config.TRAIN_BATCH_SIZE,
+                                    max_tokens=self.max_tokens,
                                     shuffle=True)
-        self.valiter = DataLoader(dataset = self.val_data, 
-                                    batch_size=self.config.EVAL_BATCH_SIZE)
+        self.valiter = self._make_dataloader(self.val_data,
+                                    batch_size=self.config.EVAL_BATCH_SIZE,
+                                    max_tokens=self.config.get("EVAL_MAX_TOKENS_PER_BATCH", None))
+
+    def _make_dataloader(self, dataset, batch_size, max_tokens = None, shuffle = False):
+        num_workers = self.config.get("NUM_WORKERS", 0)
+
+        if not max_tokens:
+            return DataLoader(dataset = dataset,
+                                batch_size=batch_size,
+                                shuffle=shuffle,
+                                num_workers=num_workers)
+
+        sampler = TokenBudgetBatchSampler(dataset.lengths,
+                                            max_tokens = max_tokens,
+                                            shuffle = shuffle,
+                                            seed = self.config.SEED)
+        return DataLoader(dataset = dataset,
+                            batch_sampler = sampler,
+                            collate_fn = trim_collate,
+                            num_workers = num_workers)
 
     def init_eval_predict_mode(self):
         self.tokenizer = AutoTokenizer.from_pretrained(self.config.pretrained_name)
@@ -223,8 +333,9 @@ class Executor():
                                             src_max_token_len = self.config.src_max_token_len,
                                             trg_max_token_len = self.config.trg_max_token_len)
             
-            self.valiter = DataLoader(dataset = self.val_data, 
-                                    batch_size=self.config.EVAL_BATCH_SIZE)
+            self.valiter = self._make_dataloader(self.val_data,
+                                    batch_size=self.config.EVAL_BATCH_SIZE,
+                                    max_tokens=self.config.get("EVAL_MAX_TOKENS_PER_BATCH", None))
 
         elif self.mode == "predict":
             print("###Load predict data ...")
@@ -236,37 +347,171 @@ class Executor():
                                             trg_max_token_len = self.config.trg_max_token_len)
             
 
-            self.predictiter = DataLoader(dataset = self.predict_data, 
-                                    batch_size=self.config.PREDICT_BATCH_SIZE)
+            self.predictiter = self._make_dataloader(self.predict_data,
+                                    batch_size=self.config.PREDICT_BATCH_SIZE,
+                                    max_tokens=self.config.get("EVAL_MAX_TOKENS_PER_BATCH", None))
 
     
-    def _evaluate(self):
-        self.model.eval()
+    def _compute_loss(self, batch):
+        label_attention_mask = batch['label_attention_mask'].to(self.config.DEVICE)
+        labels = batch['labels'].type(torch.long).to(self.config.DEVICE)
+
+        trg_input = labels[:, :-1]
+        label_attention_mask = label_attention_mask[:, :-1]
+
+        trg_out = labels[:, 1:]
+
+        if self.config.get("FUSED_LOSS", False):
+            return self.model.loss(input_ids = batch['input_ids'].to(self.config.DEVICE),
+                                    label_ids = trg_input,
+                                    src_attention_mask = batch['src_attention_mask'].to(self.config.DEVICE),
+                                    label_attention_mask = label_attention_mask,
+                                    target_ids = trg_out,
+                                    ignore_index = self.tokenizer.pad_token_id,
+                                    chunk_size = self.config.get("LOSS_VOCAB_CHUNK", 8192))
+
+        logits = self.model(input_ids = batch['input_ids'].to(self.config.DEVICE),
+                            label_ids = trg_input,
+                            src_attention_mask = batch['src_attention_mask'].to(self.config.DEVICE),
+                            label_attention_mask = label_attention_mask)
+
+        return self.loss_fn(logits.reshape(-1, logits.shape[-1]), trg_out.reshape(-1))
+
+    def _free_memory(self):
+        self.optim.zero_grad(set_to_none=True)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _backward(self, batch, chunks = 1):
+        if chunks == 1:
+            loss = self._compute_loss(batch)
+            loss.backward()
+            return loss.data.item()
+
+        # split into sub-batches weighted by their share of target tokens,
+        # so the accumulated gradient equals the one of the full batch
+        pad_id = self.tokenizer.pad_token_id
+        n_tokens = (batch['labels'][:, 1:] != pad_id).sum().item()
+
         losses = 0
-        with tqdm(desc='Validating... ' , unit='it', total=len(list(self.valiter))) as pbar:
-            with torch.no_grad():
-                for it, batch in enumerate(self.valiter):
-                    label_attention_mask = batch['label_attention_mask'].to(self.config.DEVICE)
-                    labels = batch['labels'].type(torch.long).to(self.config.DEVICE)
+        for sub_batch in zip(*[torch.tensor_split(batch[k], chunks) for k in batch]):
+            sub_batch = dict(zip(batch.keys(), sub_batch))
+            weight = (sub_batch['labels'][:, 1:] != pad_id).sum().item() / n_tokens
+            if weight == 0:
+                continue
 
-                    trg_input = labels[:, :-1]
-                    label_attention_mask = label_attention_mask[:, :-1]
+            loss = self._compute_loss(sub_batch) * weight
+            loss.backward()
+            losses += loss.data.item()
 
-                    logits = self.model(input_ids = batch['input_ids'].to(self.config.DEVICE),
-                                        label_ids = trg_input,
-                                        src_attention_mask = batch['src_attention_mask'].to(self.config.DEVICE),
-                                        label_attention_mask = label_attention_mask)
+        return losses
 
-                    trg_out = labels[:, 1:]
+    def _optimize(self, batch):
+        # evaluation switches to eval mode, which also turns gradient checkpointing off
+        self.model.train()
 
-                    loss = self.loss_fn(logits.reshape(-1, logits.shape[-1]), trg_out.reshape(-1))
-                    losses += loss.data.item()
+        chunks = min(self.chunks, batch['input_ids'].shape[0])
+        while True:
+            self.optim.zero_grad()
+            try:
+                loss = self._backward(batch, chunks)
+                break
+            except RuntimeError as e:
+                if not _is_oom(e) or chunks >= batch['input_ids'].shape[0]:
+                    raise
+            self._free_memory()
+            chunks *= 2
+            print(f"(!) Out of memory on a batch of {batch['input_ids'].shape[0]}, retrying in {chunks} chunks")
+
+        if chunks > self.chunks:
+            self.chunks = chunks
+            self.chunked_steps = 0
+        elif self.chunks > 1:
+            # batches differ in size, try fewer chunks again once in a while
+            self.chunked_steps += 1
+            if self.chunked_steps >= self.config.get("OOM_RETRY_STEPS", 100):
+                self.chunks //= 2
+                self.chunked_steps = 0
+
+        self.optim.step()
+
+        self.scheduler.step()
+
+        return loss
+
+    def _probe_max_tokens(self):
+        if not str(self.config.DEVICE).startswith("cuda"):
+            print("(!) PROBE_MAX_TOKENS needs a CUDA device, skipped")
+            return self.max_tokens
+
+        print("# Probing max tokens per batch")
+
+        datasets = [self.train_data] + ([self.pretrain_data] if self.config.DO_PRETRAINING else [])
+        dataset, longest = max(((d, i) for d in datasets for i in range(len(d))),
+                                key=lambda x: x[0].lengths[x[1]])
+        length = dataset.lengths[longest]
+        limit = self.config.get("PROBE_LIMIT", 1 << 20)
+
+        def fits(max_tokens):
+            n = max(1, max_tokens // length)
+            batch = trim_collate([dataset[longest]] * n)
+            ok = True
+            try:
+                self.optim.zero_grad()
+                self._backward(batch)
+            except RuntimeError as e:
+                if not _is_oom(e):
+                    raise
+                ok = False
+            self._free_memory()
+            print(f"\t- {max_tokens} tokens ({n} x {length}): {'ok' if ok else 'out of memory'}")
+            return ok
+
+        self.model.train()
+
+        good = 0
+        bad = self.max_tokens or 2048
+        while bad <= limit and fits(bad):
+            good = bad
+            bad *= 2
+
+        for _ in range(4):
+            if good == 0 or bad > limit or bad - good <= length:
+                break
+            mid = (good + bad) // 2
+            if fits(mid):
+                good = mid
+            else:
+                bad = mid
 
-                    pbar.set_postfix(loss=losses / (it + 1))
+        if good == 0:
+            print("(!) Even the smallest probed budget ran out of memory")
+            return self.max_tokens
+
+        # leave room for optimizer states, which are only allocated on the first step
+        max_tokens = int(good * self.config.get("PROBE_SAFETY", 0.8))
+        print(f"\t- Using MAX_TOKENS_PER_BATCH: {max_tokens}")
+        return max_tokens
+
+    def _evaluate(self):
+        self.model.eval()
+        losses = 0
+        n_tokens = 0
+        with tqdm(desc='Validating... ' , unit='it', total=len(self.valiter)) as pbar:
+            with torch.no_grad():
+                for batch in self.valiter:
+                    # weighted by target tokens: the mean over the whole set, whatever the batching
+                    tokens = (batch['labels'][:, 1:] != self.tokenizer.pad_token_id).sum().item()
+                    loss = self._compute_loss(batch)
+                    if tokens > 0:
+                        losses += loss.data.item() * tokens
+                        n_tokens += tokens
+
+                    pbar.set_postfix(loss=losses / max(n_tokens, 1))
                     pbar.update()
 
 
-        return losses / len(list(self.valiter))
+        return losses / max(n_tokens, 1)
     
     def _pretrain_step(self):
         assert self.config.NUM_PRETRAIN_STEP is not None
@@ -292,36 +537,13 @@ class Executor():
 
         while True:
             for batch in self.pretrainiter:
-                label_attention_mask = batch['label_attention_mask'].to(self.config.DEVICE)
-                labels = batch['labels'].type(torch.long).to(self.config.DEVICE)
-
-
-                trg_input = labels[:, :-1]
-                label_attention_mask = label_attention_mask[:, :-1]
-
-                logits = self.model(input_ids = batch['input_ids'].to(self.config.DEVICE),
-                                    label_ids = trg_input,
-                                    src_attention_mask = batch['src_attention_mask'].to(self.config.DEVICE),
-                                    label_attention_mask = label_attention_mask)
-
-
-                self.optim.zero_grad()
-
-                trg_out = labels[:, 1:]
-
-                loss = self.loss_fn(logits.reshape(-1, logits.shape[-1]), trg_out.reshape(-1))
-                loss.backward()
-
-                self.optim.step()
-
-                self.scheduler.step()
-                
-                losses += loss.data.item()
+                losses += self._optimize(batch)
 
                 current_step += 1
 
                 if current_step % self.config.show_loss_after_pretrain_steps == 0:
                     print(f"[Step {current_step} | {int(current_step/self.config.NUM_PRETRAIN_STEP*100)}% completed] Train Loss: {losses / current_step}")
+                    self._log_metrics(phase = "pretrain", step = current_step, loss = losses / current_step, lr = self.scheduler.get_last_lr()[0])
 
                 if current_step % self.config.save_after_pretrain_steps == 0:
                     if self.SAVE:
@@ -367,38 +589,22 @@ class Executor():
         print(f"(!) Evaluate after each {self.config.eval_after_steps} steps")
         s_train_time = timer()
 
-        while True:
-            for batch in self.trainiter:
-                label_attention_mask = batch['label_attention_mask'].to(self.config.DEVICE)
-                labels = batch['labels'].type(torch.long).to(self.config.DEVICE)
-
-
-                trg_input = labels[:, :-1]
-                label_attention_mask = label_attention_mask[:, :-1]
-
-                logits = self.model(input_ids = batch['input_ids'].to(self.config.DEVICE),
-                                    label_ids = trg_input,
-                                    src_attention_mask = batch['src_attention_mask'].to(self.config.DEVICE),
-                                    label_attention_mask = label_attention_mask)
-
-
-                self.optim.zero_grad()
-
-                trg_out = labels[:, 1:]
-
-                loss = self.loss_fn(logits.reshape(-1, logits.shape[-1]), trg_out.reshape(-1))
-                loss.backward()
+        epoch = 0
 
-                self.optim.step()
+        while True:
+            if isinstance(self.train_data, OnlineAugDataset):
+                # fresh noise every pass; workers receive a copy of the dataset when iteration starts
+                self.train_data.set_epoch(epoch)
+            epoch += 1
 
-                self.scheduler.step()
-                
-                losses += loss.data.item()
+            for batch in self.trainiter:
+                losses += self._optimize(batch)
 
                 current_step += 1
 
                 if current_step % self.config.show_loss_after_steps == 0:
                     print(f"[Step {current_step} | {int(current_step/self.config.NUM_TRAIN_STEP*100)}% completed] Train Loss: {losses / current_step}")
+                    self._log_metrics(phase = "train", step = current_step, loss = losses / current_step, lr = self.scheduler.get_last_lr()[0])
 
                 if current_step % self.config.eval_after_steps == 0:
                     eval_loss = self._evaluate()
@@ -407,6 +613,7 @@ class Executor():
                     print(f'\tTraining Step {current_step}:')
                     print(f'\tTrain Loss: {losses / current_step} - Val. Loss: {eval_loss:.4f}')
                     print(res)
+                    self._log_metrics(phase = "val", step = current_step, train_loss = losses / current_step, val_loss = eval_loss, **res)
                     
                     if m_err < err:
                         m_err = err
@@ -459,25 +666,47 @@ class Executor():
 
         return res
 
+    def _generate(self, input_ids, max_length):
+        try:
+            return self.model.generate(input_ids = input_ids,
+                                        max_length = max_length).tolist()
+        except RuntimeError as e:
+            if not _is_oom(e) or input_ids.shape[0] == 1:
+                raise
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        half = (input_ids.shape[0] + 1) // 2
+        print(f"(!) Out of memory on a batch of {input_ids.shape[0]}, retrying in halves")
+        return self._generate(input_ids[:half], max_length) + self._generate(input_ids[half:], max_length)
+
     def infer(self, dataloader, max_length):
         self.model.eval()
 
         decoded_preds = []
+        indices = []
 
-        with tqdm(desc='Inferring... ', unit='it', total=len(list(dataloader))) as pbar:
+        with tqdm(desc='Inferring... ', unit='it', total=len(dataloader)) as pbar:
             with torch.no_grad():
                 for batch in dataloader:
                    
-                    pred = self.model.generate( input_ids = batch['input_ids'].to(self.config.DEVICE),
-                                                max_length = max_length)
+                    pred = self._generate(input_ids = batch['input_ids'].to(self.config.DEVICE),
+                                            max_length = max_length)
                  
                     if self.config.modeltype == "t5":
-                        decoded_preds += self.tokenizer.batch_decode(self.infer_post_processing(pred.tolist()), skip_special_tokens=True)
+                        decoded_preds += self.tokenizer.batch_decode(self.infer_post_processing(pred), skip_special_tokens=True)
                     else:
                         decoded_preds += self.tokenizer.batch_decode(pred, skip_special_tokens=True)
 
+                    if 'index' in batch:
+                        indices += batch['index'].tolist()
+
                     pbar.update()
 
+        # token budget batches are sorted by length, restore the dataset order
+        if len(indices) == len(decoded_preds):
+            decoded_preds = [pred for _, pred in sorted(zip(indices, decoded_preds), key=lambda x: x[0])]
+
         return decoded_preds
 
 
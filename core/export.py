@@ -0,0 +1,290 @@
+import os
+import json
+import inspect
+import numpy as np
+import torch
+from torch import nn
+from transformers.modeling_outputs import BaseModelOutput
+
+try:
+    from transformers.cache_utils import DynamicCache, EncoderDecoderCache
+except ImportError:
+    # transformers < 4.42 takes the legacy tuple cache directly
+    DynamicCache = EncoderDecoderCache = None
+
+ENCODER_FILE = "encoder.onnx"
+DECODER_INIT_FILE = "decoder_init.onnx"
+DECODER_STEP_FILE = "decoder_step.onnx"
+META_FILE = "meta.json"
+
+
+def _dynamic_cache_tensors(cache):
+    if hasattr(cache, "layers"):
+        # transformers >= 4.56
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def _cache_tensors(past_key_values):
+    """``(self_key, self_value, cross_key, cross_value)`` of every decoder layer, whatever the cache format."""
+    if hasattr(past_key_values, "self_attention_cache"):
+        return [self_kv + cross_kv for self_kv, cross_kv in zip(_dynamic_cache_tensors(past_key_values.self_attention_cache),
+                                                                _dynamic_cache_tensors(past_key_values.cross_attention_cache))]
+    return [tuple(layer[:4]) for layer in past_key_values]
+
+
+def _make_cache(past, n_layers):
+    past = [tuple(past[4 * i: 4 * i + 4]) for i in range(n_layers)]
+    if EncoderDecoderCache is None:
+        return tuple(past)
+
+    self_attention_cache = DynamicCache()
+    cross_attention_cache = DynamicCache()
+    for i, (self_key, self_value, cross_key, cross_value) in enumerate(past):
+        self_attention_cache.update(self_key, self_value, i)
+        cross_attention_cache.update(cross_key, cross_value, i)
+    return EncoderDecoderCache(self_attention_cache, cross_attention_cache)
+
+
+def _run(session, feed):
+    # the exporter drops inputs a graph does not read, e.g. encoder_hidden_states in the
+    # T5 decoder step, whose cross-attention only uses the cached keys/values
+    names = {graph_input.name for graph_input in session.get_inputs()}
+    return session.run(None, {name: value for name, value in feed.items() if name in names})
+
+
+def _past_names(n_layers, prefix, cross = True):
+    names = []
+    for i in range(n_layers):
+        names += [f"{prefix}.{i}.self_key", f"{prefix}.{i}.self_value"]
+        if cross:
+            names += [f"{prefix}.{i}.cross_key", f"{prefix}.{i}.cross_value"]
+    return names
+
+
+class _Encoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids = input_ids, attention_mask = attention_mask).last_hidden_state
+
+
+class _DecoderInit(nn.Module):
+    """First decoding step: no cache in, logits of the last position and the full cache out."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, attention_mask):
+        out = self.model(encoder_outputs = BaseModelOutput(last_hidden_state = encoder_hidden_states),
+                            attention_mask = attention_mask,
+                            decoder_input_ids = decoder_input_ids,
+                            use_cache = True,
+                            return_dict = True)
+
+        return (out.logits[:, -1],) + tuple(t for layer in _cache_tensors(out.past_key_values) for t in layer)
+
+
+class _DecoderStep(nn.Module):
+    """Later decoding steps: the full cache in, logits and the grown self-attention cache out."""
+    def __init__(self, model, n_layers):
+        super().__init__()
+        self.model = model
+        self.n_layers = n_layers
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, attention_mask, *past):
+        out = self.model(encoder_outputs = BaseModelOutput(last_hidden_state = encoder_hidden_states),
+                            attention_mask = attention_mask,
+                            decoder_input_ids = decoder_input_ids,
+                            past_key_values = _make_cache(past, self.n_layers),
+                            use_cache = True,
+                            return_dict = True)
+
+        return (out.logits[:, -1],) + tuple(t for layer in _cache_tensors(out.past_key_values) for t in layer[:2])
+
+
+def _onnx_export(module, args, path, input_names, output_names, dynamic_axes, opset):
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript exporter handles the python-side cache conversion
+        kwargs["dynamo"] = False
+
+    torch.onnx.export(module, args, path,
+                        input_names = input_names,
+                        output_names = output_names,
+                        dynamic_axes = dynamic_axes,
+                        opset_version = opset,
+                        do_constant_folding = True,
+                        **kwargs)
+
+
+def export_onnx(lex_model, tokenizer, out_dir, modeltype, opset = 14, checkpoint = None):
+    """Exports the encoder and a KV-cached greedy decoder of a LexT5Model/LexBARTModel to ``out_dir``.
+
+    The model is traced on CPU in eval mode and put back on its device and in its mode
+    afterwards. ``checkpoint`` (e.g. ``{"type": "best", "step": 10000}``) is recorded in
+    ``meta.json``.
+    """
+    os.makedirs(out_dir, exist_ok = True)
+
+    model = lex_model.model
+    device = next(model.parameters()).device
+    training = model.training
+    try:
+        _export_graphs(model.cpu().eval(), tokenizer, out_dir, modeltype, opset, checkpoint)
+    finally:
+        model.to(device).train(training)
+
+    return out_dir
+
+
+def _export_graphs(model, tokenizer, out_dir, modeltype, opset, checkpoint):
+    config = model.config
+    n_layers = getattr(config, "num_decoder_layers", None) or config.decoder_layers
+    generation_config = getattr(model, "generation_config", config)
+
+    input_ids = torch.tensor(tokenizer(["xin chào các bạn", "ko bít"], padding = True)["input_ids"])
+    attention_mask = (input_ids != tokenizer.pad_token_id).long()
+    decoder_input_ids = torch.full((input_ids.shape[0], 1), config.decoder_start_token_id, dtype = torch.long)
+
+    batch_src = {0: "batch", 1: "src_len"}
+    self_past = {0: "batch", 2: "past_len"}
+    cross_past = {0: "batch", 2: "src_len"}
+
+    # torch.onnx.export restores the training flag of the exported module afterwards, which is
+    # applied to the wrapped model as well: keep the wrappers in eval mode like the model
+    with torch.no_grad():
+        encoder = _Encoder(model).eval()
+        _onnx_export(encoder, (input_ids, attention_mask), os.path.join(out_dir, ENCODER_FILE),
+                        input_names = ["input_ids", "attention_mask"],
+                        output_names = ["encoder_hidden_states"],
+                        dynamic_axes = {"input_ids": batch_src, "attention_mask": batch_src,
+                                        "encoder_hidden_states": batch_src},
+                        opset = opset)
+        encoder_hidden_states = encoder(input_ids, attention_mask)
+
+        decoder_init = _DecoderInit(model).eval()
+        present_names = _past_names(n_layers, "present")
+        _onnx_export(decoder_init, (decoder_input_ids, encoder_hidden_states, attention_mask),
+                        os.path.join(out_dir, DECODER_INIT_FILE),
+                        input_names = ["decoder_input_ids", "encoder_hidden_states", "attention_mask"],
+                        output_names = ["logits"] + present_names,
+                        dynamic_axes = {"decoder_input_ids": {0: "batch"},
+                                        "encoder_hidden_states": batch_src,
+                                        "attention_mask": batch_src,
+                                        "logits": {0: "batch"},
+                                        **{name: self_past if "self" in name else cross_past for name in present_names}},
+                        opset = opset)
+        past = decoder_init(decoder_input_ids, encoder_hidden_states, attention_mask)[1:]
+
+        decoder_step = _DecoderStep(model, n_layers).eval()
+        past_names = _past_names(n_layers, "past")
+        step_present_names = _past_names(n_layers, "present", cross = False)
+        _onnx_export(decoder_step, (decoder_input_ids, encoder_hidden_states, attention_mask) + tuple(past),
+                        os.path.join(out_dir, DECODER_STEP_FILE),
+                        input_names = ["decoder_input_ids", "encoder_hidden_states", "attention_mask"] + past_names,
+                        output_names = ["logits"] + step_present_names,
+                        dynamic_axes = {"decoder_input_ids": {0: "batch"},
+                                        "encoder_hidden_states": batch_src,
+                                        "attention_mask": batch_src,
+                                        "logits": {0: "batch"},
+                                        **{name: self_past if "self" in name else cross_past
+                                            for name in past_names + step_present_names}},
+                        opset = opset)
+
+    meta = {
+        "modeltype": modeltype,
+        "checkpoint": checkpoint,
+        "n_layers": n_layers,
+        "pad_token_id": config.pad_token_id,
+        "eos_token_id": config.eos_token_id,
+        "decoder_start_token_id": config.decoder_start_token_id,
+        "forced_bos_token_id": getattr(generation_config, "forced_bos_token_id", None),
+        "forced_eos_token_id": getattr(generation_config, "forced_eos_token_id", None),
+        "num_beams": getattr(generation_config, "num_beams", 1),
+        "no_repeat_ngram_size": getattr(generation_config, "no_repeat_ngram_size", 0),
+    }
+    with open(os.path.join(out_dir, META_FILE), "w", encoding = "utf-8") as f:
+        json.dump(meta, f, indent = 4)
+
+
+class OnnxLexModel():
+    """Greedy ``generate`` over the graphs written by ``export_onnx``, run with onnxruntime on CPU.
+
+    Mirrors ``LexT5Model.generate``/``LexBARTModel.generate`` (start token, pad after eos,
+    ``max_length`` including the start token) so it can stand in for them in ``Executor.infer``.
+    """
+    def __init__(self, export_dir, num_threads = 0):
+        import onnxruntime as ort
+
+        with open(os.path.join(export_dir, META_FILE), "r", encoding = "utf-8") as f:
+            self.meta = json.load(f)
+
+        if (self.meta["num_beams"] or 1) > 1 or (self.meta["no_repeat_ngram_size"] or 0) > 0:
+            print("(!) The ONNX backend decodes greedily, the model's generation config asks for "
+                    f"num_beams={self.meta['num_beams']}, no_repeat_ngram_size={self.meta['no_repeat_ngram_size']}")
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+
+        self.encoder = ort.InferenceSession(os.path.join(export_dir, ENCODER_FILE), options, providers = providers)
+        self.decoder_init = ort.InferenceSession(os.path.join(export_dir, DECODER_INIT_FILE), options, providers = providers)
+        self.decoder_step = ort.InferenceSession(os.path.join(export_dir, DECODER_STEP_FILE), options, providers = providers)
+
+        self.n_layers = self.meta["n_layers"]
+        self.past_names = _past_names(self.n_layers, "past")
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+    def _next_tokens(self, logits, length, max_length):
+        if length == 1 and self.meta["forced_bos_token_id"] is not None:
+            return np.full(logits.shape[0], self.meta["forced_bos_token_id"], dtype = np.int64)
+        if length == max_length - 1 and self.meta["forced_eos_token_id"] is not None:
+            return np.full(logits.shape[0], self.meta["forced_eos_token_id"], dtype = np.int64)
+        return logits.argmax(axis = -1).astype(np.int64)
+
+    def generate(self, input_ids, max_length):
+        pad_id = self.meta["pad_token_id"]
+        eos_id = self.meta["eos_token_id"]
+
+        input_ids = input_ids.cpu().numpy().astype(np.int64)
+        attention_mask = (input_ids != pad_id).astype(np.int64)
+        batch_size = input_ids.shape[0]
+
+        encoder_hidden_states = _run(self.encoder, {"input_ids": input_ids, "attention_mask": attention_mask})[0]
+
+        tokens = np.full((batch_size, 1), self.meta["decoder_start_token_id"], dtype = np.int64)
+        outputs = _run(self.decoder_init, {"decoder_input_ids": tokens,
+                                                "encoder_hidden_states": encoder_hidden_states,
+                                                "attention_mask": attention_mask})
+        logits, past = outputs[0], outputs[1:]
+
+        sequences = [tokens]
+        done = np.zeros(batch_size, dtype = bool)
+
+        for length in range(1, max_length):
+            next_tokens = np.where(done, pad_id, self._next_tokens(logits, length, max_length))
+            sequences.append(next_tokens[:, None])
+            done |= next_tokens == eos_id
+
+            if done.all() or length == max_length - 1:
+                break
+
+            outputs = _run(self.decoder_step, {"decoder_input_ids": next_tokens[:, None],
+                                                    "encoder_hidden_states": encoder_hidden_states,
+                                                    "attention_mask": attention_mask,
+                                                    **dict(zip(self.past_names, past))})
+            logits = outputs[0]
+            # the step graph only returns the self-attention cache, cross-attention keys/values never change
+            for i in range(self.n_layers):
+                past[4 * i] = outputs[1 + 2 * i]
+                past[4 * i + 1] = outputs[2 + 2 * i]
+
+        return torch.from_numpy(np.concatenate(sequences, axis = 1))
@@ -1,5 +1,112 @@
 from transformers import AutoModelForSeq2SeqLM
 from torch import nn
+import torch
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """Mean cross-entropy of ``hidden @ weight.T + bias`` computed ``chunk_size`` vocabulary rows at a time.
+
+    Only ``[N, chunk_size]`` logits exist at any moment: the forward pass keeps a running
+    log-sum-exp and the backward pass recomputes each chunk instead of saving it.
+    """
+    @staticmethod
+    def _dtype(hidden):
+        # at least float32 for the log-sum-exp, double stays double
+        return torch.promote_types(hidden.dtype, torch.float32)
+
+    @staticmethod
+    def _logits(hidden, weight, bias, start, end):
+        dtype = ChunkedCrossEntropy._dtype(hidden)
+        logits = (hidden @ weight[start:end].t()).to(dtype)
+        if bias is not None:
+            logits = logits + bias[start:end].to(dtype)
+        return logits
+
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, targets, chunk_size):
+        n = hidden.shape[0]
+        dtype = ChunkedCrossEntropy._dtype(hidden)
+        running_max = hidden.new_full((n,), float("-inf"), dtype=dtype)
+        running_sum = hidden.new_zeros((n,), dtype=dtype)
+        target_logits = hidden.new_zeros((n,), dtype=dtype)
+        rows = torch.arange(n, device=hidden.device)
+
+        for start in range(0, weight.shape[0], chunk_size):
+            end = min(start + chunk_size, weight.shape[0])
+            logits = ChunkedCrossEntropy._logits(hidden, weight, bias, start, end)
+
+            new_max = torch.maximum(running_max, logits.max(dim=1).values)
+            running_sum = running_sum * torch.exp(running_max - new_max) + torch.exp(logits - new_max[:, None]).sum(dim=1)
+            running_max = new_max
+
+            in_chunk = (targets >= start) & (targets < end)
+            target_logits[in_chunk] = logits[rows[in_chunk], targets[in_chunk] - start]
+
+        lse = running_max + torch.log(running_sum)
+
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(hidden, weight, bias, targets, lse)
+
+        return (lse - target_logits).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        hidden, weight, bias, targets, lse = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        rows = torch.arange(hidden.shape[0], device=hidden.device)
+        dtype = ChunkedCrossEntropy._dtype(hidden)
+        scale = grad_output.to(dtype) / hidden.shape[0]
+
+        grad_hidden = torch.zeros_like(hidden, dtype=dtype)
+        grad_weight = torch.zeros_like(weight) if ctx.needs_input_grad[1] else None
+        grad_bias = torch.zeros_like(bias) if bias is not None and ctx.needs_input_grad[2] else None
+
+        for start in range(0, weight.shape[0], chunk_size):
+            end = min(start + chunk_size, weight.shape[0])
+            logits = ChunkedCrossEntropy._logits(hidden, weight, bias, start, end)
+
+            # d loss / d logits = softmax - one_hot(target)
+            grad_logits = torch.exp(logits - lse[:, None])
+            in_chunk = (targets >= start) & (targets < end)
+            grad_logits[rows[in_chunk], targets[in_chunk] - start] -= 1
+            grad_logits = (grad_logits * scale).to(hidden.dtype)
+
+            grad_hidden += (grad_logits @ weight[start:end]).to(dtype)
+            if grad_weight is not None:
+                grad_weight[start:end] = grad_logits.t() @ hidden
+            if grad_bias is not None:
+                grad_bias[start:end] = grad_logits.sum(dim=0)
+
+        return grad_hidden.to(hidden.dtype), grad_weight, grad_bias, None, None
+
+
+def chunked_cross_entropy(hidden, lm_head, targets, ignore_index, chunk_size = 8192):
+    """Same value as ``CrossEntropyLoss(ignore_index)(lm_head(hidden), targets)`` without full-vocab logits."""
+    keep = targets != ignore_index
+    hidden = hidden[keep]
+    targets = targets[keep]
+
+    if targets.numel() == 0:
+        # zero gradients (not None) for lm_head too, like CrossEntropyLoss on an all-pad batch
+        loss = hidden.sum() * 0 + lm_head.weight.sum() * 0
+        if lm_head.bias is not None:
+            loss = loss + lm_head.bias.sum() * 0
+        return loss
+
+    return ChunkedCrossEntropy.apply(hidden, lm_head.weight, lm_head.bias, targets, chunk_size)
+
+
+def enable_gradient_checkpointing(model):
+    """Recomputes the encoder/decoder layer activations in backward instead of storing them.
+
+    Takes effect in the ``encoder``/``decoder`` stacks called directly by ``decode``, in train mode only.
+    """
+    try:
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    except TypeError:
+        # transformers < 4.35
+        model.gradient_checkpointing_enable()
+
 
 class LexBARTModel(nn.Module):
     def __init__(self, 
@@ -9,7 +116,10 @@ class LexBARTModel(nn.Module):
 
         self.model = AutoModelForSeq2SeqLM.from_pretrained(pretrained_name)
 
-    def forward(self, 
+    def enable_gradient_checkpointing(self):
+        enable_gradient_checkpointing(self.model)
+
+    def decode(self, 
                 input_ids, 
                 label_ids, 
                 src_attention_mask, 
@@ -20,19 +130,42 @@ class LexBARTModel(nn.Module):
                 inputs_embeds=self.model.model.shared(input_ids),
             ).last_hidden_state
 
-        decoder_outputs = self.model.model.decoder(
+        return self.model.model.decoder(
             encoder_hidden_states = encoder_outputs,
             inputs_embeds = self.model.model.shared(label_ids),
-            attention_mask = label_attention_mask
+            attention_mask = label_attention_mask,
+            use_cache = False
         ).last_hidden_state
 
+    def forward(self, 
+                input_ids, 
+                label_ids, 
+                src_attention_mask, 
+                label_attention_mask):
+
+        decoder_outputs = self.decode(input_ids, label_ids, src_attention_mask, label_attention_mask)
 
         return self.model.lm_head(decoder_outputs)
+
+    def loss(self, 
+                input_ids, 
+                label_ids, 
+                src_attention_mask, 
+                label_attention_mask,
+                target_ids,
+                ignore_index,
+                chunk_size = 8192):
+
+        decoder_outputs = self.decode(input_ids, label_ids, src_attention_mask, label_attention_mask)
+
+        return chunked_cross_entropy(decoder_outputs, self.model.lm_head, target_ids, ignore_index, chunk_size)
     
     def generate(self, 
                 input_ids, 
                 max_length):
+        # transformers >= 5 no longer derives the mask from the pad tokens
         return self.model.generate(input_ids = input_ids,
+                                    attention_mask = (input_ids != self.model.config.pad_token_id).long(),
                                     max_length = max_length)
 
 class LexT5Model(nn.Module):
@@ -43,7 +176,10 @@ class LexT5Model(nn.Module):
 
         self.model = AutoModelForSeq2SeqLM.from_pretrained(pretrained_name)
 
-    def forward(self, 
+    def enable_gradient_checkpointing(self):
+        enable_gradient_checkpointing(self.model)
+
+    def decode(self, 
                 input_ids, 
                 label_ids, 
                 src_attention_mask, 
@@ -54,17 +190,40 @@ class LexT5Model(nn.Module):
                 inputs_embeds=self.model.shared(input_ids),
             ).last_hidden_state
 
-        decoder_outputs = self.model.decoder(
+        return self.model.decoder(
             encoder_hidden_states = encoder_outputs,
             inputs_embeds = self.model.shared(label_ids),
-            attention_mask = label_attention_mask
+            attention_mask = label_attention_mask,
+            use_cache = False
         ).last_hidden_state
 
+    def forward(self, 
+                input_ids, 
+                label_ids, 
+                src_attention_mask, 
+                label_attention_mask):
+
+        decoder_outputs = self.decode(input_ids, label_ids, src_attention_mask, label_attention_mask)
 
         return self.model.lm_head(decoder_outputs)
+
+    def loss(self, 
+                input_ids, 
+                label_ids, 
+                src_attention_mask, 
+                label_attention_mask,
+                target_ids,
+                ignore_index,
+                chunk_size = 8192):
+
+        decoder_outputs = self.decode(input_ids, label_ids, src_attention_mask, label_attention_mask)
+
+        return chunked_cross_entropy(decoder_outputs, self.model.lm_head, target_ids, ignore_index, chunk_size)
     
     def generate(self, 
                 input_ids, 
                 max_length):
+        # transformers >= 5 no longer derives the mask from the pad tokens
         return self.model.generate(input_ids = input_ids, 
+                                    attention_mask = (input_ids != self.model.config.pad_token_id).long(),
                                     max_length = max_length)
\ No newline at end of file
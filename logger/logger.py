@@ -1,24 +1,150 @@
+import os
 import sys
+import json
+import queue
+import atexit
+import logging
+import traceback
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from timeit import default_timer as timer
+
 
 class Logger(object):
-    def __init__(self, filename):
+    """Tees stdout/stderr into a rotating transcript and records metrics as JSON lines.
+
+    Writes never touch the disk on the caller's thread: messages are pushed onto a
+    queue and a background ``QueueListener`` does the file I/O. Carriage-return
+    progress bar refreshes (tqdm) are rate-limited to one every
+    ``progress_interval`` seconds.
+    """
+
+    TRANSCRIPT = "vilexnorm.transcript"
+    METRICS = "vilexnorm.metrics"
+
+    def __init__(self,
+                filename,
+                metrics_filename = None,
+                resume = False,
+                max_bytes = 10 * 1024 * 1024,
+                backup_count = 5,
+                progress_interval = 5.0):
         self.filename = filename
+        self.metrics_filename = metrics_filename or os.path.join(os.path.dirname(filename) or ".", "metrics.jsonl")
+        self.resume = resume
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.progress_interval = progress_interval
+
+        self.listener = None
+        self.stdout = None
+        self.stderr = None
 
     class Transcript:
-        def __init__(self, filename):
-            self.terminal = sys.stdout
-            self.log = open(filename, "w")
+        def __init__(self, terminal, logger, progress_interval):
+            self.terminal = terminal
+            self.logger = logger
+            self.progress_interval = progress_interval
+            self.pending = None
+            self.last_progress = 0.0
+
         def __getattr__(self, attr):
             return getattr(self.terminal, attr)
+
         def write(self, message):
             self.terminal.write(message)
-            self.log.write(message)
+
+            if "\r" in message:
+                now = timer()
+                if now - self.last_progress < self.progress_interval:
+                    self.pending = message
+                    return
+                self.last_progress = now
+                self.pending = None
+            else:
+                self.flush_pending()
+
+            self.logger.info(message)
+
+        def flush_pending(self):
+            if self.pending is not None:
+                self.logger.info(self.pending)
+                self.pending = None
+
         def flush(self):
-            pass
+            self.terminal.flush()
+
+    def _file_handler(self, filename, logger_name, terminator):
+        handler = RotatingFileHandler(filename,
+                                        maxBytes = self.max_bytes,
+                                        backupCount = self.backup_count,
+                                        encoding = "utf-8",
+                                        delay = True)
+        if not self.resume and os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            # keep the previous run's output as a backup instead of clobbering it
+            handler.doRollover()
+
+        handler.terminator = terminator
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        handler.addFilter(logging.Filter(logger_name))
+        return handler
+
+    def _queue_logger(self, name, log_queue):
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(QueueHandler(log_queue))
+        return logger
 
     def start(self):
-        sys.stdout = self.Transcript(self.filename)
+        log_queue = queue.SimpleQueue()
+
+        self.listener = QueueListener(log_queue,
+                                        self._file_handler(self.filename, self.TRANSCRIPT, ""),
+                                        self._file_handler(self.metrics_filename, self.METRICS, "\n"))
+        self.listener.start()
+        atexit.register(self.stop)
+
+        transcript = self._queue_logger(self.TRANSCRIPT, log_queue)
+        self.metrics_logger = self._queue_logger(self.METRICS, log_queue)
+
+        self.stdout = self.Transcript(sys.stdout, transcript, self.progress_interval)
+        self.stderr = self.Transcript(sys.stderr, transcript, self.progress_interval)
+        sys.stdout = self.stdout
+        sys.stderr = self.stderr
+
+    def log_metrics(self, **record):
+        """Appends one structured record, e.g. ``log_metrics(phase="train", step=200, loss=0.31)``."""
+        if self.listener is None:
+            return
+        self.metrics_logger.info(json.dumps(record, ensure_ascii=False, default=float))
+
+    def log_exception(self):
+        """Writes the traceback of the exception being handled to the transcript (not the terminal).
+
+        Call it before ``stop``: the interpreter only prints an uncaught exception once
+        the real stderr is back, so the transcript would miss it.
+        """
+        if self.listener is None:
+            return
+        self.stderr.flush_pending()
+        self.stderr.logger.info(traceback.format_exc())
 
     def stop(self):
-        sys.stdout.log.close()
-        sys.stdout = sys.stdout.terminal
\ No newline at end of file
+        if self.listener is None:
+            return
+
+        for stream in (self.stdout, self.stderr):
+            stream.flush_pending()
+
+        if sys.stdout is self.stdout:
+            sys.stdout = self.stdout.terminal
+        if sys.stderr is self.stderr:
+            sys.stderr = self.stderr.terminal
+
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        self.listener = None
+        atexit.unregister(self.stop)
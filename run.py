@@ -6,15 +6,15 @@ import argparse
 def parse_args():
     parser = argparse.ArgumentParser(description='Exp Args')
 
-    parser.add_argument("--mode", choices=['train', 'eval', 'predict'],
-                      help='{train, eval, predict}',
+    parser.add_argument("--mode", choices=['train', 'eval', 'predict', 'export'],
+                      help='{train, eval, predict, export}',
                       type=str, required=True)
     
     parser.add_argument("--evaltype", choices=['last', 'best'],
                       help='{last, best}',
                       type=str, nargs='?', const=1, default='last')
     parser.add_argument("--predicttype", choices=['last', 'best'],
-                      help='{last, best}',
+                      help='{last, best}, also the checkpoint exported in export mode',
                       type=str, nargs='?', const=1, default='best')
     
     parser.add_argument("--config-file", type=str, required=True)